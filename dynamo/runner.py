@@ -1,29 +1,71 @@
 import argparse
+import importlib
+import json
 import logging
+import multiprocessing
+import os
 import pickle
 import sys
+from collections import ChainMap
 from datetime import datetime
 from functools import partial
 from itertools import product
 from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Sequence
+from typing import Set
 from typing import Tuple
 from typing import Union
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import torch
-import torch._dynamo as dynamo
+import torch._dynamo
 import torch.utils.benchmark as benchmark
 import yaml
 from kornia.core import Tensor
-from yaml.loader import SafeLoader
+from torch.utils.benchmark.utils.common import TaskSpec
+
+try:
+    # libyaml backed parser, when PyYAML was built with it
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 
 torch.set_float32_matmul_precision('high')
-torch_dynamo_optimize = dynamo.optimize('inductor')
+_CPU = torch.device('cpu')
+_CUDA = torch.device('cuda')
+_compile_cpu = torch.compile(backend='inductor')
+# CUDA graphs remove the per-launch overhead of small and medium kernels
+_compile_cuda = torch.compile(mode='reduce-overhead')
+_compile_cuda_autotune = torch.compile(mode='max-autotune')
+# Each shape of the sweep is a new guard, the default limit of 8 recompiles
+# would make dynamo fall back to eager mode mid sweep.
+torch._dynamo.config.cache_size_limit = 64
+
+# Compiled callables keyed by (import_from, operator, optimizer, input shape,
+# device), so dynamo traces each operator only once per shape.
+_COMPILED_CACHE: Dict[
+    Tuple[str, str, str, Tuple[int, ...], torch.device], Callable[..., Any],
+] = {}
+# Runs which already passed `_check_run`, to skip their warm-up call
+_VALIDATED: Set[Tuple[Any, ...]] = set()
+# Operators resolved once per (import_from, operator)
+_OP_CACHE: Dict[Tuple[str, str], Callable[..., Any]] = {}
+# Time budgets (in seconds) used to rank each benchmark
+_MIN_RUN_TIME = 1.0
+# Shorter budgets for ranking-only passes, see `--ranking`
+_RANKING_CPU_MIN_RUN_TIME = 0.2
+_RANKING_CUDA_MIN_RUN_TIME = 0.1
+# Length of each event-timed block of the CUDA measurements
+_CUDA_BLOCK_TIME = 0.05
+# Bump when the flattened output of `load_config` changes
+_CONFIG_CACHE_VERSION = 2
 
 
 def create_inputs(
@@ -36,9 +78,8 @@ def create_inputs(
 ) -> Union[Tensor, np.ndarray]:
 
     if RGB:
-        x_tensor = torch.ones((3, res, res), dtype=dtype, device=device)
-        if bs is not None:
-            x_tensor = x_tensor[None].repeat(bs, 1, 1, 1)
+        shape = (3, res, res) if bs is None else (bs, 3, res, res)
+        x_tensor = torch.ones(shape, dtype=dtype, device=device)
     else:
         # TODO
         raise NotImplementedError
@@ -50,6 +91,10 @@ def create_inputs(
     return x_array
 
 
+def _iter_threads(configs: List[Dict[str, Any]]) -> List[int]:
+    return sorted({t for cfg in configs for t in cfg['threads']})
+
+
 def _iter_cfg(
         configs: List[Dict[str, Any]],
 ) -> Tuple[Dict[str, Any], int, int, int]:
@@ -58,15 +103,51 @@ def _iter_cfg(
             yield cfg, bs, res
 
 
-def _iter_op_device() -> Tuple[str, str, str, Tuple[Any]]:
+def _format_arg(arg: Any) -> str:
+    if isinstance(arg, _CreateOnes):
+        return str(tuple(arg.keywords['shape']))
+    return str(arg)
+
+
+def _describe_cfg(
+        cfg: Dict[str, Any],
+        bs: int,
+        res: int,
+) -> Tuple[str, str]:
+    _args_values_str = ', '.join(
+        _format_arg(v) for v in cfg['kwargs'].values()
+    )
+    sub_label = f'[{bs}, {res}, {_args_values_str}]'
+    cfg_txt = (
+        f'Module: {cfg["module"]} |'
+        f'Batch size={bs}, '
+        f'resolution={res}, args={_args_values_str}'
+    )
+    return sub_label, cfg_txt
+
+
+def _iter_op_device(
+        max_autotune: bool = False,
+) -> Tuple[str, str, torch.device, Tuple[Any]]:
     # TODO: Maybe automate this?
     _iters = [
-        ('kornia_op', 'tensor', 'cpu', None),
-        ('kornia_op', 'tensor', 'cuda', None),
-        ('kornia_op', 'tensor', 'cpu', ('dynamo', torch_dynamo_optimize)),
-        ('kornia_op', 'tensor', 'cuda', ('dynamo', torch_dynamo_optimize)),
-        ('opencv_op', 'numpy', 'cpu', None),
+        ('kornia_op', 'tensor', _CPU, None),
+        ('kornia_op', 'tensor', _CUDA, None),
+        ('kornia_op', 'tensor', _CPU, ('dynamo', _compile_cpu)),
+        ('kornia_op', 'tensor', _CUDA, ('dynamo-rovh', _compile_cuda)),
+        ('opencv_op', 'numpy', _CPU, None),
     ]
+    if max_autotune:
+        _iters.insert(
+            4,
+            ('kornia_op', 'tensor', _CUDA, (
+                'dynamo-autotune', _compile_cuda_autotune,
+            )),
+        )
+
+    # Avoid running (and failing) every config on machines without a GPU
+    _has_cuda = torch.cuda.is_available()
+    _iters = [row for row in _iters if row[2].type != 'cuda' or _has_cuda]
 
     for operator, input_type, device, optimize in _iters:
         if optimize is None:
@@ -81,21 +162,65 @@ def _iter_op_device() -> Tuple[str, str, str, Tuple[Any]]:
         yield operator, input_type, device, (_opt_name, _opt_txt, _opt)
 
 
-def _check_run(
-        verbose: bool,
+def _resolve_op(import_from: str, operator: str) -> Callable[..., Any]:
+    key = (import_from, operator)
+    if key not in _OP_CACHE:
+        module = importlib.import_module(import_from)
+        _OP_CACHE[key] = getattr(module, operator)
+
+    return _OP_CACHE[key]
+
+
+def _compile_op(
         module: str,
         operator: str,
+        op: Callable[..., Any],
         x: Union[Tensor, np.ndarray],
+        opt_name: str,
         optimizer: Any,
+        device: torch.device,
+) -> Callable[..., Any]:
+    if not optimizer:
+        return op
+
+    key = (module, operator, opt_name, tuple(x.shape), device)
+    if key not in _COMPILED_CACHE:
+        _COMPILED_CACHE[key] = optimizer(op)
+
+    return _COMPILED_CACHE[key]
+
+
+def _validation_key(
+        module: str,
+        operator: str,
+        opt_name: str,
+        device: torch.device,
+        x: Union[Tensor, np.ndarray],
+        kwargs: Dict[str, Any],
+) -> Tuple[Any, ...]:
+    # Arrays are described by their shape, other arguments by their value
+    _kwargs_key = tuple(sorted(
+        (
+            k, type(v).__name__,
+            tuple(v.shape) if hasattr(v, 'shape') else repr(v),
+        )
+        for k, v in kwargs.items()
+    ))
+    return (
+        module, operator, opt_name, device, tuple(x.shape), str(x.dtype),
+        _kwargs_key,
+    )
+
+
+def _check_run(
+        verbose: bool,
+        module: str,
+        op: Callable[..., Any],
+        x: Union[Tensor, np.ndarray],
         **kwargs: Dict[str, Any]
 ) -> bool:
     try:
-        module = __import__(module, fromlist=[None])
-        op = getattr(module, operator)
-        if optimizer:
-            optimizer(op)(x, **kwargs)
-        else:
-            op(x, **kwargs)
+        op(x, **kwargs)
         return True
     except Exception as err:
         if verbose:
@@ -111,17 +236,6 @@ def _check_run(
         return False
 
 
-def _unpack_config_or_load_global(
-        config_name: str,
-        data: Dict[str, Any],
-        global_data: Dict[str, Any],
-) -> Any:
-    if config_name in data:
-        return data[config_name]
-
-    return global_data[config_name]
-
-
 def create_ones(
         shape: Tuple[int, ...],
         out_t: str,
@@ -136,6 +250,11 @@ def create_ones(
     return x_array
 
 
+class _CreateOnes(partial):
+    # Tags the `ones` constructors of the config, to be built per device
+    __slots__ = ()
+
+
 def _unpack_config(i):
     if isinstance(i, dict):
         if 'ones' in i:
@@ -146,7 +265,7 @@ def _unpack_config(i):
             elif isinstance(i['ones'], list) and len(i['ones']) == 1:
                 _d = int(i['ones'][0])
                 shape = (_d, _d)
-            return partial(create_ones, shape=shape)
+            return _CreateOnes(create_ones, shape=shape)
         else:
             raise NotImplementedError
     return i
@@ -154,53 +273,121 @@ def _unpack_config(i):
 
 def dict_product(data):
     # Same as itertools.product but between dict values
-    prod_cases = {k: v for k, v in data.items() if not callable(v)}
-    others = {k: v for k, v in data.items() if callable(v)}
+    keys = tuple(k for k, v in data.items() if not isinstance(v, _CreateOnes))
+    values = tuple(data[k] for k in keys)
+    others = {k: v for k, v in data.items() if isinstance(v, _CreateOnes)}
+
+    for element in product(*values):
+        out = dict(zip(keys, element))
+        out.update(others)
+        yield out
+
+
+def _encode_config_value(value: Any) -> Any:
+    if isinstance(value, _CreateOnes):
+        return {'__ones__': list(value.keywords['shape'])}
+
+    raise TypeError(f'Cannot serialize config value {value!r}')
+
+
+def _decode_config_value(data: Dict[str, Any]) -> Any:
+    if '__ones__' in data:
+        return _CreateOnes(create_ones, shape=tuple(data['__ones__']))
 
-    for element in product(*prod_cases.values()):
-        out_prod = dict(zip(prod_cases.keys(), element))
-        yield {**out_prod, **others}
+    return data
 
 
-def load_config(filename: str) -> List[Dict[str, Any]]:
+def _load_cached_config(
+        cache_filename: str,
+        stat: os.stat_result,
+) -> Optional[List[Dict[str, Any]]]:
+    try:
+        with open(cache_filename) as f:
+            cached = json.load(f, object_hook=_decode_config_value)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        cached.get('version') != _CONFIG_CACHE_VERSION
+        or cached.get('mtime') != stat.st_mtime_ns
+        or cached.get('size') != stat.st_size
+    ):
+        return None
+
+    return cached['config']
+
+
+def _save_cached_config(
+        cache_filename: str,
+        stat: os.stat_result,
+        config: List[Dict[str, Any]],
+) -> None:
+    cached = {
+        'version': _CONFIG_CACHE_VERSION,
+        'mtime': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'config': config,
+    }
+    try:
+        with open(cache_filename, 'w') as f:
+            json.dump(cached, f, default=_encode_config_value)
+    except (OSError, TypeError):
+        # The cache is only an optimization, a failure here is not fatal
+        if os.path.exists(cache_filename):
+            os.remove(cache_filename)
+
+
+def load_config(
+        filename: str,
+        use_cache: bool = True,
+) -> List[Dict[str, Any]]:
+    # The flattened config is cached at `<filename>.cache.json` and reused
+    # while the YAML file keeps the same mtime and size.
+    cache_filename = f'{filename}.cache.json'
+    stat = os.stat(filename)
+    if use_cache:
+        config = _load_cached_config(cache_filename, stat)
+        if config is not None:
+            return config
+
+    config = _parse_config(filename)
+
+    if use_cache:
+        _save_cached_config(cache_filename, stat, config)
+
+    return config
+
+
+def _parse_config(filename: str) -> List[Dict[str, Any]]:
     with open(filename) as f:
-        data = yaml.load(f, Loader=SafeLoader)
+        data = yaml.load(f, Loader=_Loader)
 
     global_config = data['global']
 
     DEFAULT_CONFIGS = ['batch_sizes', 'resolutions', 'threads', 'import_from']
 
-    config = [
-        {
-            'module': k,
-            'kwargs': lc,
-            ** {
-                cn: _unpack_config_or_load_global(cn, v, global_config)
-                for cn in DEFAULT_CONFIGS
-            },
-        }
-        for k, v in data.items() if k != 'global'
+    config = []
+    for k, v in data.items():
+        if k == 'global':
+            continue
+
+        # Per operation configs take precedence over the global ones
+        merged = ChainMap(v, global_config)
+        defaults = {cn: merged[cn] for cn in DEFAULT_CONFIGS}
         for lc in dict_product(
             {
                 cn: _unpack_config(cv) for cn, cv in v.items()
-                if cv not in DEFAULT_CONFIGS and cn != 'no_args'
+                if cn not in DEFAULT_CONFIGS and cn != 'no_args'
             },
-        )
-    ]
+        ):
+            config.append({'module': k, 'kwargs': lc, **defaults})
 
     return config
 
 
-def _unpick(filename: str) -> list[Any]:
-    results = []
+def _unpick(filename: str) -> List[Any]:
     with open(filename, 'rb') as fp:
-        try:
-            while True:
-                results.append(pickle.load(fp))
-        except EOFError:
-            pass
-
-    return results
+        return pickle.load(fp)
 
 
 def _build_kwargs(
@@ -209,108 +396,467 @@ def _build_kwargs(
         dtype: torch.dtype = torch.float32,
         device: torch.device = torch.device('cpu'),
 ):
-    def _unpack_arg(arg,  out_t=out_t, dtype=dtype, device=device):
-        if callable(arg):
-            return arg(out_t=out_t, dtype=dtype, device=device)
-        return arg
-
     return {
-        k: _unpack_arg(v)
+        k: (
+            v(out_t=out_t, dtype=dtype, device=device)
+            if isinstance(v, _CreateOnes) else v
+        )
         for k, v in f_kwargs.items()
     }
 
 
-def run(
-        configs: List[Dict[str, Any]],
-        output_filename: str,
+def _cuda_blocked_autorange(
+        op: Callable[..., Any],
+        x: Tensor,
+        kwargs: Dict[str, Any],
+        task_spec: TaskSpec,
+        min_run_time: float = _MIN_RUN_TIME,
+        single_block: bool = False,
+        warmup: int = 3,
+) -> benchmark.Measurement:
+    # Time the kernels with CUDA events and synchronize only once per block,
+    # instead of the `torch.cuda.synchronize()` per call done by the Timer.
+    # Blocks are recorded until `min_run_time`, a single one of that length
+    # is enough for ranking-only passes.
+    for _ in range(warmup):
+        op(x, **kwargs)
+
+    start = torch.cuda.Event(enable_timing=True)
+    end = torch.cuda.Event(enable_timing=True)
+
+    start.record()
+    op(x, **kwargs)
+    end.record()
+    end.synchronize()
+    # Event timings are in milliseconds, floor it to the event resolution
+    estimate = max(start.elapsed_time(end) / 1e3, 1e-6)
+
+    block_time = (
+        min_run_time if single_block
+        else min(_CUDA_BLOCK_TIME, min_run_time)
+    )
+    number = max(3, int(block_time / estimate))
+
+    raw_times: List[float] = []
+    while not raw_times or (
+        not single_block and sum(raw_times) < min_run_time
+    ):
+        start.record()
+        for _ in range(number):
+            op(x, **kwargs)
+        end.record()
+        end.synchronize()
+        raw_times.append(start.elapsed_time(end) / 1e3)
+
+    return benchmark.Measurement(
+        number_per_run=number,
+        raw_times=raw_times,
+        task_spec=task_spec,
+    )
+
+
+# Pure inference benchmark, the autograd bookkeeping is just overhead. The
+# Timer runs the statement in this thread, so it inherits the mode.
+@torch.inference_mode()
+def _run_row(
+        row: Tuple[str, str, torch.device, Tuple[Any]],
+        cases: List[Tuple[Dict[str, Any], int, int, str, str]],
+        thread_counts: List[int],
         verbose: bool,
-) -> int:
-    with open(output_filename, 'wb') as fp:
-        for operator, input_type, device, optimize in _iter_op_device():
-            _opt_name, _opt_txt, _opt = optimize
-            _op_dev_txt = (
-                f'\033[1;33m {operator} at {device} {_opt_txt}'
-                '\033[0;0m'
+        ranking: bool = False,
+        max_threads: Optional[int] = None,
+) -> List[benchmark.Measurement]:
+    operator, input_type, device, optimize = row
+    if not ranking:
+        min_run_time = _MIN_RUN_TIME
+    elif device.type == 'cuda':
+        min_run_time = _RANKING_CUDA_MIN_RUN_TIME
+    else:
+        min_run_time = _RANKING_CPU_MIN_RUN_TIME
+    _opt_name, _opt_txt, _opt = optimize
+    _op_dev_txt = (
+        f'\033[1;33m {operator} at {device} {_opt_txt}'
+        '\033[0;0m'
+    )
+    desc = f'{_opt_name}{operator.split("_")[0]}_{device.type}'
+    sys.stdout.write(f'{"-" * 79}\n-> Benchmarking{_op_dev_txt}\n')
+
+    if max_threads is not None:
+        # More threads than pinned cores would oversubscribe them
+        skipped = [t for t in thread_counts if t > max_threads]
+        if skipped:
+            sys.stdout.write(
+                '\033[1;31m'
+                f'-> ({_op_dev_txt}) skipping num_threads={skipped}, only '
+                f'{max_threads} cores are available to this row'
+                '\033[0;0m\n',
             )
-            print(
-                '-'*79,
-                f'\n-> Benchmarking{_op_dev_txt}',
+        thread_counts = [t for t in thread_counts if t <= max_threads]
+
+    results: List[benchmark.Measurement] = []
+    default_num_threads = torch.get_num_threads()
+    # The input only depends on (bs, res), the last one is reused by the
+    # following cases of the same size. Only one input is alive at a time.
+    x_key: Optional[Tuple[int, int]] = None
+    x = None
+    try:
+        # Group the row by the number of threads, so the intra-op thread
+        # pool is resized once per bucket instead of between adjacent configs.
+        for num_threads in thread_counts:
+            torch.set_num_threads(num_threads)
+            sys.stdout.write(
+                f'{"=" * 79}\n->({_op_dev_txt}) '
+                f'with num_threads={num_threads}\n',
             )
 
-            for cfg, bs, res in _iter_cfg(configs):
-                x = create_inputs(
-                    bs, res, input_type,
-                    device=torch.device(device),
+            for cfg, bs, res, sub_label, cfg_txt in cases:
+                if num_threads not in cfg['threads']:
+                    continue
+
+                sys.stdout.write(
+                    f'\n\n\t {"-" * 70}\n\t->({_op_dev_txt}) {cfg_txt}\n',
                 )
 
+                if x_key != (bs, res):
+                    # Give the blocks back, large configs would OOM otherwise
+                    x = None
+                    if device.type == 'cuda':
+                        torch.cuda.empty_cache()
+
+                    x = create_inputs(
+                        bs, res, input_type,
+                        device=device,
+                    )
+                    x_key = (bs, res)
+
                 kwargs = _build_kwargs(
                     cfg['kwargs'],
                     out_t=input_type,
-                    device=torch.device(device),
+                    device=device,
                 )
 
                 module_name = cfg['module']
                 import_from = f'{cfg["import_from"]}.{module_name}'
 
-                _args_values_str = ', '.join(
-                    str(tuple(v.shape)) if hasattr(v, 'shape')
-                    else str(v)
-                    for v in kwargs.values()
-                )
-                sub_label = f'[{bs}, {res}, {_args_values_str}]'
-
-                print(
-                    '\n\n\t', '-'*70, '\n'
-                    f'\t->({_op_dev_txt}) Module: {module_name} |'
-                    f'Batch size={bs}, '
-                    f'resolution={res}, args={_args_values_str}',
-                )
-
-                if _check_run(
-                        verbose, import_from, operator, x, _opt, **kwargs
-                ):
-                    for num_threads in cfg['threads']:
+                try:
+                    op = _resolve_op(import_from, operator)
+                except Exception as err:
+                    if verbose:
                         print(
-                            '\t\t-> benchmarking with '
-                            f'num_threads={num_threads}...',
+                            '\033[1;31m',
+                            f'\t\tException on importing {import_from}\n',
+                            err,
+                            '\033[0;0m',
                         )
-
-                        desc = f'{_opt_name}{operator.split("_")[0]}_{device}'
-                        stmt = f'{operator}(input, **kwargs)'
-                        setup = f'from {import_from} import {operator}'
-
+                    op = None
+                else:
+                    op = _compile_op(
+                        import_from, operator, op, x, _opt_name, _opt, device,
+                    )
+                    key = _validation_key(
+                        import_from, operator, _opt_name, device, x, kwargs,
+                    )
+                    if key not in _VALIDATED:
+                        if _check_run(verbose, import_from, op, x, **kwargs):
+                            _VALIDATED.add(key)
+                        else:
+                            op = None
+
+                if op is not None:
+                    if device.type == 'cuda':
+                        bench_out = _cuda_blocked_autorange(
+                            op, x, kwargs,
+                            TaskSpec(
+                                stmt='op(input, **kwargs)',
+                                setup='',
+                                num_threads=num_threads,
+                                label=module_name,
+                                sub_label=sub_label,
+                                description=desc,
+                            ),
+                            min_run_time=min_run_time,
+                            single_block=ranking,
+                        )
+                    else:
                         bench_out = benchmark.Timer(
-                            stmt=stmt,
-                            setup=setup,
-                            globals={'input': x, 'kwargs': kwargs},
+                            stmt='op(input, **kwargs)',
+                            setup='',
+                            globals={'op': op, 'input': x, 'kwargs': kwargs},
                             num_threads=num_threads,
                             label=module_name,
                             sub_label=sub_label,
                             description=desc,
-                        ).blocked_autorange(min_run_time=1)
+                        ).blocked_autorange(min_run_time=min_run_time)
 
-                        print(
-                            '\033[1;32m'
-                            '\t\t-> Saving benchmark...'
-                            '\033[0;0m',
-                        )
-                        pickle.dump(
-                            bench_out,
-                            fp,
-                            protocol=pickle.HIGHEST_PROTOCOL,
-                        )
+                    results.append(bench_out)
                 else:
-                    print(
+                    sys.stdout.write(
                         '\033[1;31m'
                         '\t\t-> Fail to run. Skipping benchmark...'
-                        '\033[0;0m',
+                        '\033[0;0m\n',
+                    )
+
+                sys.stdout.flush()
+                del kwargs
+    finally:
+        torch.set_num_threads(default_num_threads)
+
+    del x
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+    if _opt:
+        # Drop the compiled graphs of this row, which pin device memory
+        _COMPILED_CACHE.clear()
+        torch._dynamo.reset()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    return results
+
+
+def _available_cores() -> List[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+
+def _split_cores(cores: List[int], n: int) -> List[List[int]]:
+    # Disjoint sets of contiguous cores, requires at least one core per set
+    size = len(cores) // n
+    return [cores[i * size:(i + 1) * size] for i in range(n)]
+
+
+def _set_affinity(cores: Optional[List[int]]) -> None:
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+
+def _setup_dynamo_logging(log_level: Optional[int]) -> None:
+    if log_level is not None:
+        torch._dynamo.config.verbose = True
+        torch._dynamo.config.log_level = log_level
+
+
+def _run_row_worker(
+        index: int,
+        max_autotune: bool,
+        cases: List[Tuple[Dict[str, Any], int, int, str, str]],
+        thread_counts: List[int],
+        verbose: bool,
+        ranking: bool,
+        log_level: Optional[int],
+        cores: Optional[List[int]],
+        filename: str,
+) -> None:
+    # Entry point of the worker processes, the rows are rebuilt here since
+    # the compiled callables can not be sent across processes. The workers
+    # are spawned, so the dynamo logging of `main` is set up again.
+    _setup_dynamo_logging(log_level)
+    _set_affinity(cores)
+    row = list(_iter_op_device(max_autotune))[index]
+    results = _run_row(
+        row, cases, thread_counts, verbose, ranking,
+        max_threads=len(cores) if cores is not None else None,
+    )
+    with open(filename, 'wb') as fp:
+        pickle.dump(results, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _run_sweep(
+        configs: List[Dict[str, Any]],
+        output_filename: str,
+        verbose: bool,
+        max_autotune: bool = False,
+        parallel: bool = False,
+        ranking: bool = False,
+        log_level: Optional[int] = None,
+) -> Tuple[List[benchmark.Measurement], int]:
+    op_devices = list(_iter_op_device(max_autotune))
+    thread_counts = _iter_threads(configs)
+    # The labels only depend on the config, build them once for the sweep
+    cases = [
+        (cfg, bs, res, *_describe_cfg(cfg, bs, res))
+        for cfg, bs, res in _iter_cfg(configs)
+    ]
+
+    # Each CPU row runs in its own process pinned to a disjoint set of cores,
+    # the CUDA rows share the GPU so they run one at a time in this process.
+    cpu_rows = [i for i, row in enumerate(op_devices) if row[2].type == 'cpu']
+    cuda_rows = [i for i in range(len(op_devices)) if i not in cpu_rows]
+    n_core_sets = len(cpu_rows) + bool(cuda_rows)
+    cores = _available_cores()
+    if parallel and len(cores) < n_core_sets:
+        print(
+            '\033[1;31m'
+            f'-> Only {len(cores)} cores for {n_core_sets} parallel rows, '
+            'running the sweep serially instead'
+            '\033[0;0m',
+        )
+        parallel = False
+    elif parallel and min(thread_counts) > len(cores) // n_core_sets:
+        print(
+            '\033[1;31m'
+            f'-> No num_threads={thread_counts} fits in the '
+            f'{len(cores) // n_core_sets} cores of each parallel row, '
+            'running the sweep serially instead'
+            '\033[0;0m',
+        )
+        parallel = False
+
+    if not parallel:
+        results: List[benchmark.Measurement] = []
+        for row in op_devices:
+            results.extend(
+                _run_row(row, cases, thread_counts, verbose, ranking),
+            )
+        return results, 0
+
+    core_sets = _split_cores(cores, n_core_sets)
+
+    ctx = multiprocessing.get_context('spawn')
+    workers = []
+    rows_results: Dict[int, List[benchmark.Measurement]] = {}
+    failed = 0
+    try:
+        for index, row_cores in zip(cpu_rows, core_sets):
+            filename = f'{output_filename}.row{index}'
+            worker = ctx.Process(
+                target=_run_row_worker,
+                args=(
+                    index, max_autotune, cases, thread_counts, verbose,
+                    ranking, log_level, row_cores, filename,
+                ),
+            )
+            worker.start()
+            workers.append((index, worker, filename))
+
+        if cuda_rows:
+            default_cores = (
+                os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity')
+                else None
+            )
+            _set_affinity(core_sets[-1])
+            try:
+                # The CUDA timing does not depend on the number of threads,
+                # so these rows are not limited to the pinned cores.
+                for index in cuda_rows:
+                    rows_results[index] = _run_row(
+                        op_devices[index], cases, thread_counts, verbose,
+                        ranking,
                     )
+            finally:
+                _set_affinity(default_cores)
+
+        for index, worker, filename in workers:
+            worker.join()
+            if worker.exitcode != 0:
+                failed += 1
+                print(
+                    '\033[1;31m'
+                    f'-> Worker for row {op_devices[index][:3]} failed with '
+                    f'exit code {worker.exitcode}'
+                    '\033[0;0m',
+                )
+                continue
+
+            rows_results[index] = _unpick(filename)
+    finally:
+        # On errors the workers may still be running, stop them and do not
+        # leave their partial results next to the output.
+        for _, worker, filename in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    results = [
+        bench_out
+        for index in sorted(rows_results)
+        for bench_out in rows_results[index]
+    ]
+    return results, failed
+
+
+def _to_records(
+        results: List[benchmark.Measurement],
+) -> List[Dict[str, Any]]:
+    return [
+        {
+            'label': m.task_spec.label,
+            'sub_label': m.task_spec.sub_label,
+            'description': m.task_spec.description,
+            'num_threads': m.task_spec.num_threads,
+            'stmt': m.task_spec.stmt,
+            'times': np.asarray(m.times, dtype=np.float64),
+        }
+        for m in results
+    ]
+
+
+def save_results(
+        results: List[benchmark.Measurement],
+        filename: str,
+) -> None:
+    # One row per measurement, the repeated labels are dictionary encoded
+    table = pa.Table.from_pylist(_to_records(results))
+    pq.write_table(table, filename)
+
+
+def load_results(filename: str) -> List[benchmark.Measurement]:
+    # Rebuild the measurements, to be used with `benchmark.Compare`
+    return [
+        benchmark.Measurement(
+            number_per_run=1,
+            raw_times=record['times'],
+            task_spec=TaskSpec(
+                stmt=record['stmt'],
+                setup='',
+                num_threads=record['num_threads'],
+                label=record['label'],
+                sub_label=record['sub_label'],
+                description=record['description'],
+            ),
+        )
+        for record in pq.read_table(filename).to_pylist()
+    ]
+
+
+def run(
+        configs: List[Dict[str, Any]],
+        output_filename: str,
+        verbose: bool,
+        max_autotune: bool = False,
+        parallel: bool = False,
+        ranking: bool = False,
+        log_level: Optional[int] = None,
+) -> int:
+    results, failed = _run_sweep(
+        configs, output_filename, verbose, max_autotune, parallel, ranking,
+        log_level,
+    )
+
+    if not results:
+        print(
+            '\033[1;31m'
+            '-> No benchmark was run, nothing to save'
+            '\033[0;0m',
+        )
+        return 1
 
-    ab_results = _unpick(output_filename)
-    compare = benchmark.Compare(ab_results)
+    print(
+        '\033[1;32m'
+        f'-> Saving benchmarks to {output_filename}...'
+        '\033[0;0m',
+    )
+    save_results(results, output_filename)
+
+    compare = benchmark.Compare(results)
     compare.print()
 
-    return 0
+    return 1 if failed else 0
 
 
 def main(argv: Optional[Sequence[str]] = None) -> int:
@@ -325,6 +871,36 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
         default='bench_config.yaml',
         help='Filename for the YAML config for the runner',
     )
+    parser.add_argument(
+        '--no-config-cache',
+        action='store_true',
+        default=False,
+        help='Always parse the YAML config, ignoring its cached version',
+    )
+    parser.add_argument(
+        '--max-autotune',
+        action='store_true',
+        default=False,
+        help='Also benchmark torch.compile(mode=\'max-autotune\') on CUDA',
+    )
+    parser.add_argument(
+        '--parallel',
+        action='store_true',
+        default=False,
+        help=(
+            'Run each CPU row in its own process pinned to a disjoint set of '
+            'cores, while the CUDA rows run in the main process'
+        ),
+    )
+    parser.add_argument(
+        '--ranking',
+        action='store_true',
+        default=False,
+        help=(
+            'Ranking-only pass, time each benchmark for about 0.2s on CPU '
+            'and 0.1s on CUDA instead of 1s'
+        ),
+    )
     parser.add_argument(
         '--verbose',
         action='store_true',
@@ -338,25 +914,33 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     _dt = datetime.strftime(datetime.utcnow(), '%Y%m%d_%H%M%S')
     parser.add_argument(
         '--output-filename',
-        default=f'output-benchmark-{_dt}.pickle',
-        help='Filename for the pickle output file',
+        default=f'output-benchmark-{_dt}.parquet',
+        help='Filename for the parquet output file',
     )
 
     args = parser.parse_args(argv)
 
-    configs = load_config(args.config_filename)
+    configs = load_config(
+        args.config_filename,
+        use_cache=not args.no_config_cache,
+    )
 
     if args.verbose:
-        torch._dynamo.config.verbose = True
-        torch._dynamo.config.log_level = logging.INFO
+        log_level = logging.INFO
     elif args.debug:
-        torch._dynamo.config.verbose = True
-        torch._dynamo.config.log_level = logging.DEBUG
+        log_level = logging.DEBUG
+    else:
+        log_level = None
+    _setup_dynamo_logging(log_level)
 
     return run(
         configs,
         output_filename=args.output_filename,
         verbose=args.verbose or args.debug,
+        max_autotune=args.max_autotune,
+        parallel=args.parallel,
+        ranking=args.ranking,
+        log_level=log_level,
     )
 
 